@@ -11,10 +11,17 @@ Galaxy Stream Identification Web App
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
-from PIL import Image, ImageOps
+from PIL import Image
 from io import BytesIO
-import json
+import os
+import csv
+import hashlib
+import orjson
+import asyncio
+import threading
+import httpx
 from pathlib import Path
 from datetime import datetime
 from streamlit_shortcuts import add_shortcuts
@@ -40,23 +47,34 @@ if 'save_file' not in st.session_state:
     st.session_state.save_file = None
 if 'data_loaded' not in st.session_state:
     st.session_state.data_loaded = False
-if 'auto_save_interval' not in st.session_state:
-    st.session_state.auto_save_interval = 5
-if 'labels_since_save' not in st.session_state:
-    st.session_state.labels_since_save = 0
 if 'save_directory' not in st.session_state:
     st.session_state.save_directory = str(Path.cwd())
 if 'edit_mode' not in st.session_state:
     st.session_state.edit_mode = False
+if 'prefetch_futures' not in st.session_state:
+    st.session_state.prefetch_futures = {}
+if 'prefetch_bytes' not in st.session_state:
+    st.session_state.prefetch_bytes = {}
+
+
+@st.cache_data(show_spinner=False)
+def _parse_csv(raw):
+    """解析 CSV 字节内容 (缓存, 同一文件只解析一次)"""
+    return pd.read_csv(BytesIO(raw))
 
 
 def load_csv_data(uploaded_file):
-    """加载 CSV 文件"""
+    """加载 CSV 文件 (按内容哈希判重, 重复上传同一文件不再解析)"""
     try:
-        df = pd.read_csv(uploaded_file)
+        raw = uploaded_file.getvalue()
+        digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        if st.session_state.get('csv_digest') == digest and st.session_state.galaxy_data is not None:
+            return st.session_state.galaxy_data
+        df = _parse_csv(raw)
         if 'image_url' not in df.columns:
             st.error("❌ CSV 文件必须包含 'image_url' 列!")
             return None
+        st.session_state.csv_digest = digest
         return df
     except Exception as e:
         st.error(f"❌ 加载 CSV 失败: {e}")
@@ -64,58 +82,475 @@ def load_csv_data(uploaded_file):
 
 
 def load_existing_labels(file_path):
-    """加载已有的标注结果"""
+    """加载已有的标注结果 (JSON 快照 + JSONL 增量合并)"""
+    results = {}
     try:
         if Path(file_path).exists():
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                return {int(k): v for k, v in data.items()}
+            with open(file_path, 'rb') as f:
+                data = orjson.loads(f.read())
+                results = {int(k): v for k, v in data.items()}
     except Exception as e:
         st.warning(f"⚠️ 无法加载已有标注: {e}")
-    return {}
+    results.update(load_jsonl_labels(file_path))
+    return results
 
 
-def save_results(file_path, results):
-    """保存标注结果"""
+def append_jsonl(file_path, idx, record):
+    """追加单条标注到 JSONL 增量文件 (O(1), 避免每次重写整个 JSON)"""
     try:
-        with open(file_path, 'w') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        jsonl_path = Path(file_path).with_suffix('.jsonl')
+        with open(jsonl_path, 'ab') as f:
+            f.write(orjson.dumps({idx: record}, option=orjson.OPT_NON_STR_KEYS) + b'\n')
         return True
     except Exception as e:
         st.error(f"❌ 保存失败: {e}")
         return False
 
 
-def load_image_from_url(url):
-    """从 URL 加载图像"""
+def load_jsonl_labels(file_path):
+    """读取 JSONL 增量文件并合并为字典 (同一索引后写覆盖先写)"""
+    results = {}
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        img = Image.open(BytesIO(response.content))
-        return img
+        jsonl_path = Path(file_path).with_suffix('.jsonl')
+        if jsonl_path.exists():
+            with open(jsonl_path, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        for k, v in orjson.loads(line).items():
+                            results[int(k)] = v
     except Exception as e:
-        st.error(f"❌ 加载图像失败: {e}")
-        return None
+        st.warning(f"⚠️ 无法加载增量标注: {e}")
+    return results
+
+
+def save_results(file_path, results):
+    """保存标注结果 (先写临时文件再原子重命名, 中途崩溃不会损坏已有文件)"""
+    try:
+        file_path = Path(file_path)
+        tmp_path = file_path.with_suffix(file_path.suffix + '.tmp')
+        with open(tmp_path, 'wb', buffering=1 << 20) as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        st.error(f"❌ 保存失败: {e}")
+        return False
+
+
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    """带连接池的 HTTP 会话 (缓存单例, rerun 不重建, 复用 TCP/TLS 连接)"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=2)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _download_bytes(url):
+    """下载图像原始字节"""
+    response = _http_session().get(url, timeout=10)
+    response.raise_for_status()
+    return response.content
+
+
+@st.cache_resource(show_spinner=False)
+def _prefetch_runtime():
+    """后台事件循环 + HTTP/2 客户端 (缓存单例, rerun 不会重复创建)
+
+    预取走 HTTP/2: K 个并发请求在同一条连接上多路复用, 总延迟接近单个 RTT.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    client = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_connections=16),
+    )
+    return loop, client
+
+
+async def _download_bytes_async(client, url):
+    """异步下载图像原始字节 (在后台事件循环中执行)"""
+    response = await client.get(url)
+    response.raise_for_status()
+    return response.content
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _fetch_image_bytes(url):
+    """下载图像原始字节 (缓存, 同一 URL 只请求一次网络)"""
+    return _download_bytes(url)
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _display_image_bytes(url, inverted, _idx=None):
+    """生成用于显示的缩略图字节 (缓存键: url + 是否反转)
+
+    原图解码后缩放到显示宽度并重编码为 WEBP, 发往浏览器的
+    websocket 负载缩小数倍; 同一 (图像, 反转状态) 只处理一次.
+    """
+    raw = None
+    future = st.session_state.prefetch_futures.pop(_idx, None)
+    if future is not None:
+        try:
+            raw = future.result()
+        except Exception:
+            # 预取失败 (超时/404 等) 不致命, 回退到同步路径重试
+            raw = None
+        else:
+            # 暂存原始字节: 同一张图的另一反转状态渲染时无需重新下载
+            bytes_cache = st.session_state.prefetch_bytes
+            bytes_cache[url] = raw
+            while len(bytes_cache) > 16:
+                bytes_cache.pop(next(iter(bytes_cache)))
+    if raw is None:
+        raw = st.session_state.prefetch_bytes.get(url)
+    if raw is None:
+        raw = _fetch_image_bytes(url)
+    img = Image.open(BytesIO(raw))
+
+    if inverted:
+        # 单次向量化减法反转 RGB 通道 (保留 alpha), 避免 PIL 的多次 split/merge 拷贝
+        if img.mode == 'RGBA':
+            arr = np.asarray(img).copy()
+            arr[..., :3] = 255 - arr[..., :3]
+            img = Image.fromarray(arr, 'RGBA')
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img = Image.fromarray(255 - np.asarray(img), 'RGB')
+
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    img.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+    buf = BytesIO()
+    img.save(buf, format='WEBP', quality=85)
+    return buf.getvalue()
+
+
+def prefetch_images(urls, idx, count=4):
+    """预取后续若干张图像, 隐藏 "标注 → 下一个" 路径的网络延迟"""
+    futures = st.session_state.prefetch_futures
+    loop, client = _prefetch_runtime()
+    for j in range(idx + 1, min(idx + 1 + count, len(urls))):
+        # 失败的预取直接丢弃, 本轮重新提交
+        existing = futures.get(j)
+        if existing is not None and existing.done() and existing.exception() is not None:
+            del futures[j]
+        if j not in futures:
+            futures[j] = asyncio.run_coroutine_threadsafe(
+                _download_bytes_async(client, urls[j]), loop
+            )
+    # 回收已经浏览过的预取结果, 控制内存占用
+    for j in [k for k in futures if k < idx - 2]:
+        del futures[j]
+
+
+def first_unlabeled_index(total, results):
+    """向量化查找第一个未标注的索引 (全部已标注时返回 None)
+
+    结果按 len(results) 缓存, 重复 rerun 不会重复扫描.
+    """
+    cached = st.session_state.get('_first_unlabeled_cache')
+    if cached is not None and cached[0] == len(results):
+        return cached[1]
+    mask = np.ones(total, dtype=bool)
+    if results:
+        labeled = np.fromiter(results.keys(), dtype=np.int64, count=len(results))
+        mask[labeled[labeled < total]] = False
+    first = int(mask.argmax()) if mask.any() else None
+    st.session_state._first_unlabeled_cache = (len(results), first)
+    return first
+
+
+def apply_label(kind, url, idx, metadata, is_labeled):
+    """写入一条标注并增量保存 (三个分类按钮共用的逻辑)"""
+    result = {
+        'url': url,
+        'classification': kind,
+        'index': idx,
+        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'metadata': metadata
+    }
+    if is_labeled:
+        result['edited'] = True
+
+    st.session_state.results[idx] = result
+    codes = st.session_state.get('class_codes')
+    if codes is not None and idx < len(codes):
+        codes[idx] = _CLASS_CODES[kind]
+
+    name = {'has_stream': 'Has Stream', 'no_stream': 'No Stream', 'skipped': 'Skipped'}[kind]
+    prefix = '⏭️' if kind == 'skipped' else '✅'
+    notify = st.warning if kind == 'skipped' else st.success
+
+    # 增量追加保存 (O(1), 不重写整个文件)
+    if append_jsonl(st.session_state.save_file, idx, result):
+        if is_labeled and st.session_state.edit_mode:
+            notify(f"{prefix} 已修改为 {name} 并立即保存")
+        else:
+            notify(f"{prefix} 已标注: {name} (已增量保存)")
+    st.rerun()
+
+
+@st.cache_resource(show_spinner=False)
+def _dir_options():
+    """构建保存目录选项 (缓存, 每次 rerun 不再重复 stat 文件系统)"""
+    cwd = Path.cwd()
+    home = Path.home()
+    data_dir = cwd / "Data"
+    options = {
+        f"📁 当前目录: {cwd}": str(cwd),
+        f"🏠 主目录: {home}": str(home),
+    }
+    if data_dir.exists():
+        options[f"📊 Data目录: {data_dir}"] = str(data_dir)
+    options[f"⬆️ 上级目录: {cwd.parent}"] = str(cwd.parent)
+    options["✏️ 自定义路径..."] = "custom"
+    return options
+
+
+# 分类 → int8 编码 (class_codes 数组用, -1 表示未标注)
+_CLASS_CODES = {'has_stream': 0, 'no_stream': 1, 'skipped': 2}
+
+
+def _rebuild_class_codes(total, results):
+    """根据 results 字典重建分类编码数组"""
+    codes = np.full(total, -1, dtype=np.int8)
+    for i, r in results.items():
+        if 0 <= i < total:
+            codes[i] = _CLASS_CODES.get(r['classification'], -1)
+    return codes
 
 
 def get_summary_stats(results):
-    """获取统计摘要"""
+    """获取统计摘要 (对编码数组做一次 bincount, 不逐条遍历字典)"""
     total = len(st.session_state.galaxy_data) if st.session_state.galaxy_data is not None else 0
-    classified = len(results)
-    has_stream = sum(1 for r in results.values() if r['classification'] == 'has_stream')
-    no_stream = sum(1 for r in results.values() if r['classification'] == 'no_stream')
-    skipped = sum(1 for r in results.values() if r['classification'] == 'skipped')
-    
+
+    codes = st.session_state.get('class_codes')
+    if codes is None or len(codes) != total or int((codes >= 0).sum()) != len(results):
+        codes = _rebuild_class_codes(total, results)
+        st.session_state.class_codes = codes
+
+    labeled = codes >= 0
+    classified = int(labeled.sum())
+    counts = np.bincount(codes[labeled], minlength=3)
+
     return {
         'total': total,
         'classified': classified,
         'unclassified': total - classified,
-        'has_stream': has_stream,
-        'no_stream': no_stream,
-        'skipped': skipped
+        'has_stream': int(counts[0]),
+        'no_stream': int(counts[1]),
+        'skipped': int(counts[2])
     }
 
 
+@st.fragment
+def annotation_panel(df):
+    """标注主面板 (fragment: 面板内的交互不会触发侧边栏重渲染)"""
+    idx = st.session_state.current_index
+
+    # 获取当前星系数据 (URL 走预先物化的元组, 不经过 pandas 行索引)
+    urls = st.session_state.get('urls')
+    if urls is None:
+        urls = st.session_state.urls = tuple(df['image_url'].astype(str).tolist())
+    current_row = df.iloc[idx]
+    url = urls[idx]
+
+    # 行元数据转字典只做一次, 之后的每次点击直接复用
+    metadata = st.session_state.setdefault('_meta_cache', {}).setdefault(idx, current_row.to_dict())
+
+    # 检查是否已标注
+    is_labeled = idx in st.session_state.results
+
+    # 标题和进度
+    st.title(f"🌌 Galaxy {idx + 1} of {len(df)}")
+
+    # 进度条
+    progress = idx / len(df)
+    st.progress(progress, text=f"进度: {idx + 1}/{len(df)}")
+
+    # 显示元数据 (单个 st.code 组件, 而不是每列一个 st.text)
+    with st.expander("📋 星系元数据"):
+        metadata_cols = st.session_state.get('metadata_cols')
+        if metadata_cols is None:
+            metadata_cols = st.session_state.metadata_cols = [c for c in df.columns if c != 'image_url']
+        if metadata_cols:
+            st.code('\n'.join(f"{c}: {current_row[c]}" for c in metadata_cols))
+        else:
+            st.info("无额外元数据")
+
+    st.markdown("---")
+
+    # 图像显示区域
+    col_img, col_controls = st.columns([2, 1])
+
+    with col_img:
+        # 加载图像 (缩略图 WEBP 字节, 按 url + 反转状态缓存)
+        with st.spinner("加载图像中..."):
+            try:
+                payload = _display_image_bytes(url, st.session_state.is_inverted, _idx=idx)
+            except Exception as e:
+                st.error(f"❌ 加载图像失败: {e}")
+                payload = None
+
+        if payload is not None:
+            st.image(payload, use_container_width=True, caption=f"Galaxy {idx + 1}")
+
+        # 当前图像已显示, 后台预取接下来的几张
+        prefetch_images(urls, idx)
+
+    with col_controls:
+        st.header("🎮 控制面板")
+
+        # 编辑模式开关
+        st.subheader("🔓 编辑模式")
+        edit_mode = st.toggle(
+            "启用编辑模式",
+            value=st.session_state.edit_mode,
+            key="edit_mode_toggle",
+            help="开启后可以修改已标注的结果"
+        )
+        st.session_state.edit_mode = edit_mode
+
+        if edit_mode:
+            st.warning("⚠️ 编辑模式已启用 - 可修改已标注结果")
+        else:
+            st.info("🔒 编辑模式已关闭 - 已标注结果被锁定")
+
+        st.markdown("---")
+
+        # 图像控制
+        st.subheader("🖼️ 图像控制")
+        if st.button("🔄 反转图像", use_container_width=True, key="invert_btn"):
+            st.session_state.is_inverted = not st.session_state.is_inverted
+            st.rerun(scope="fragment")
+
+        if st.session_state.is_inverted:
+            st.info("📍 当前: 反转模式")
+        else:
+            st.info("📍 当前: 正常模式")
+
+        st.markdown("---")
+
+        # 分类按钮
+        st.subheader("🏷️ 分类")
+
+        # 检查是否已标注和编辑模式状态
+        if is_labeled and not st.session_state.edit_mode:
+            # 显示已有标注（锁定状态）
+            result = st.session_state.results[idx]
+            classification = result['classification']
+            timestamp = result.get('timestamp', 'Unknown')
+
+            if classification == 'has_stream':
+                st.success("✅ Has Stream")
+            elif classification == 'no_stream':
+                st.error("❌ No Stream")
+            else:
+                st.warning("⏭️ Skipped")
+
+            st.caption(f"标注时间: {timestamp}")
+            st.info("🔒 已标注,不可修改 (开启编辑模式以更改)")
+
+        else:
+            # 显示分类按钮（未标注 或 编辑模式已启用）
+            if is_labeled and st.session_state.edit_mode:
+                st.warning("⚠️ 编辑模式已启用 - 可以修改此标注")
+                # 显示当前标注
+                result = st.session_state.results[idx]
+                classification = result['classification']
+                if classification == 'has_stream':
+                    st.info("当前: ✅ Has Stream")
+                elif classification == 'no_stream':
+                    st.info("当前: ❌ No Stream")
+                else:
+                    st.info("当前: ⏭️ Skipped")
+
+            col1, col2, col3 = st.columns(3)
+
+            with col1:
+                if st.button("✅ Has\nStream", use_container_width=True, type="primary", key="has_stream_btn"):
+                    apply_label('has_stream', url, idx, metadata, is_labeled)
+
+            with col2:
+                if st.button("❌ No\nStream", use_container_width=True, key="no_stream_btn"):
+                    apply_label('no_stream', url, idx, metadata, is_labeled)
+
+            with col3:
+                if st.button("⏭️ Skip", use_container_width=True, key="skip_btn"):
+                    apply_label('skipped', url, idx, metadata, is_labeled)
+
+            if is_labeled and st.session_state.edit_mode:
+                st.caption("修改将立即保存")
+            else:
+                st.caption("请选择分类")
+
+    st.markdown("---")
+
+    # 导航按钮
+    col_prev, col_next = st.columns(2)
+
+    with col_prev:
+        if st.button("⬅️ 上一个", use_container_width=True, disabled=(idx == 0), key="prev_btn"):
+            st.session_state.current_index = max(0, idx - 1)
+            st.session_state.is_inverted = False
+            st.rerun(scope="fragment")
+
+    with col_next:
+        # 修改禁用条件：到达最后一个 或者 当前未标注
+        next_disabled = (idx >= len(df) - 1) or not is_labeled
+        next_btn_text = "下一个 ➡️" if is_labeled else "下一个 ➡️ (需先标注)"
+        if st.button(next_btn_text, use_container_width=True, disabled=next_disabled, type="primary", key="next_btn"):
+            st.session_state.current_index = min(len(df) - 1, idx + 1)
+            st.session_state.is_inverted = False
+            st.rerun(scope="fragment")
+
+    # 状态提示
+    if not is_labeled:
+        st.warning("⚠️ 警告: 请先分类当前星系才能继续到下一个")
+
+    # 快捷键提示
+    with st.expander("⌨️ 快捷键说明"):
+        st.markdown("""
+        - **E**: 切换编辑模式
+        - **I**: 反转图像
+        - **Y**: 标注为 Has Stream
+        - **N**: 标注为 No Stream
+        - **S**: 跳过当前图像
+        - **←**: 上一个星系
+        - **→**: 下一个星系
+        """)
+
+    # 添加快捷键支持 - 移到这里以确保所有按钮都已渲染
+    # 配置按 (是否已标注, 编辑模式) 记忆, 状态不变时不重建字典
+    shortcut_key = (is_labeled, st.session_state.edit_mode)
+    if st.session_state.get('_shortcut_key') != shortcut_key:
+        shortcut_config = {
+            "edit_mode_toggle": "e",      # E键切换编辑模式
+            "invert_btn": "i",            # I键反转图像
+            "prev_btn": "arrowleft",      # 左箭头上一个
+        }
+
+        # 只有在未标注或编辑模式开启时才启用分类快捷键
+        if not is_labeled or st.session_state.edit_mode:
+            shortcut_config["has_stream_btn"] = "y"   # Y键标注为Has Stream
+            shortcut_config["no_stream_btn"] = "n"    # N键标注为No Stream
+            shortcut_config["skip_btn"] = "s"         # S键跳过
+
+        # 只有在已标注时才启用下一个快捷键（已移除，现在自动前进）
+        # if is_labeled and idx < len(df) - 1:
+        #     shortcut_config["next_btn"] = "arrowright"  # 右箭头下一个
+
+        st.session_state._shortcut_key = shortcut_key
+        st.session_state._shortcut_cfg = shortcut_config
+
+    add_shortcuts(**st.session_state._shortcut_cfg)
+
+
 # ============================================================================
 # 侧边栏 - 文件加载和配置
 # ============================================================================
@@ -135,6 +570,9 @@ if uploaded_file is not None and not st.session_state.data_loaded:
     df = load_csv_data(uploaded_file)
     if df is not None:
         st.session_state.galaxy_data = df
+        # 元数据列和 URL 序列固定不变, 只算一次
+        st.session_state.metadata_cols = [c for c in df.columns if c != 'image_url']
+        st.session_state.urls = tuple(df['image_url'].astype(str).tolist())
         st.sidebar.success(f"✅ 已加载 {len(df)} 个星系")
         
         # 显示数据预览
@@ -155,68 +593,65 @@ if st.session_state.galaxy_data is not None:
     )
     
     if existing_file is not None:
+        raw_labels = existing_file.getvalue()
+        labels_digest = hashlib.blake2b(raw_labels, digest_size=16).hexdigest()
+    else:
+        raw_labels = None
+        labels_digest = None
+
+    # 按内容哈希判重: 同一份上传只处理一次, 避免每次 rerun 重建结果并跳转索引
+    if raw_labels is not None and st.session_state.get('labels_digest') != labels_digest:
         try:
-            content = existing_file.read().decode('utf-8')
-            data = json.loads(content)
-            st.session_state.results = {int(k): v for k, v in data.items()}
+            # orjson 直接解析字节, 省去 decode 成 str 的整份拷贝
+            data = orjson.loads(raw_labels)
+            total_galaxies = len(st.session_state.galaxy_data) if st.session_state.galaxy_data is not None else 0
+            # 单次遍历: 同时转换整数键并填充分类编码数组
+            results = {}
+            codes = np.full(total_galaxies, -1, dtype=np.int8)
+            for k, v in data.items():
+                i = int(k)
+                results[i] = v
+                if 0 <= i < total_galaxies:
+                    codes[i] = _CLASS_CODES.get(v['classification'], -1)
+            st.session_state.results = results
+            st.session_state.class_codes = codes
             st.sidebar.success(f"✅ 已加载 {len(st.session_state.results)} 条标注")
-            # 使用上传文件的名称
-            st.session_state.save_file = Path(st.session_state.save_directory) / existing_file.name
-            
-            # 重置自动保存计数器
-            st.session_state.labels_since_save = 0
-            
+            # 使用上传文件的名称 (目录/文件名未变时复用已构造的 Path)
+            save_key = (st.session_state.save_directory, existing_file.name)
+            if st.session_state.get('_save_file_key') != save_key:
+                st.session_state._save_file_key = save_key
+                st.session_state.save_file = Path(st.session_state.save_directory) / existing_file.name
+
+            # 合并 JSONL 增量文件中更新的标注 (同步更新编码数组)
+            for i, v in load_jsonl_labels(st.session_state.save_file).items():
+                st.session_state.results[i] = v
+                if 0 <= i < total_galaxies:
+                    codes[i] = _CLASS_CODES.get(v['classification'], -1)
+
             # 自动跳转到第一个未标注的星系
             if st.session_state.galaxy_data is not None:
                 total_galaxies = len(st.session_state.galaxy_data)
-                for i in range(total_galaxies):
-                    if i not in st.session_state.results:
-                        st.session_state.current_index = i
-                        st.sidebar.info(f"💡 已跳转到第一个未标注的星系 (#{i + 1})")
-                        break
+                first = first_unlabeled_index(total_galaxies, st.session_state.results)
+                if first is not None:
+                    st.session_state.current_index = first
+                    st.sidebar.info(f"💡 已跳转到第一个未标注的星系 (#{first + 1})")
                 else:
                     # 所有都已标注，跳转到最后一个
                     st.session_state.current_index = total_galaxies - 1
                     st.sidebar.info("💡 所有星系已标注完成")
+
+            st.session_state.labels_digest = labels_digest
         except Exception as e:
             st.sidebar.error(f"❌ 加载失败: {e}")
     
     st.sidebar.markdown("---")
+
+    # 2.2 新建保存文件
+    st.sidebar.markdown("**2.2 新建保存文件**")
     
-    # 2.2 自动保存间隔
-    st.sidebar.markdown("**2.2 自动保存设置**")
-    st.session_state.auto_save_interval = st.sidebar.number_input(
-        "每标注几个自动保存",
-        min_value=1,
-        max_value=50,
-        value=st.session_state.auto_save_interval,
-        step=1,
-        help="标注指定数量后自动保存结果"
-    )
-    
-    st.sidebar.markdown("---")
-    
-    # 2.3 新建保存文件
-    st.sidebar.markdown("**2.3 新建保存文件**")
-    
-    # 获取常用目录
-    current_dir = Path.cwd()
-    home_dir = Path.home()
-    data_dir = current_dir / "Data"
-    parent_dir = current_dir.parent
-    
-    # 构建目录选项
-    dir_options = {
-        f"📁 当前目录: {current_dir}": str(current_dir),
-        f"🏠 主目录: {home_dir}": str(home_dir),
-    }
-    
-    if data_dir.exists():
-        dir_options[f"📊 Data目录: {data_dir}"] = str(data_dir)
-    
-    dir_options[f"⬆️ 上级目录: {parent_dir}"] = str(parent_dir)
-    dir_options["✏️ 自定义路径..."] = "custom"
-    
+    # 常用目录选项 (缓存)
+    dir_options = _dir_options()
+
     # 选择目录方式
     selected_option = st.sidebar.selectbox(
         "选择保存目录",
@@ -256,7 +691,33 @@ if st.session_state.galaxy_data is not None:
         )
         
         if save_filename:
-            st.session_state.save_file = Path(st.session_state.save_directory) / save_filename
+            # 目录/文件名未变时复用已构造的 Path
+            save_key = (st.session_state.save_directory, save_filename)
+            if st.session_state.get('_save_file_key') != save_key:
+                st.session_state._save_file_key = save_key
+                st.session_state.save_file = Path(st.session_state.save_directory) / save_filename
+
+                # 磁盘上已有同名快照/增量文件时自动恢复 (崩溃后只剩 JSONL 也能续传)
+                # 仅在当前会话还没有任何标注时进行, 且逐条校验 URL 属于当前数据集,
+                # 避免把旧数据集的残留文件当作本次的标注合并进来
+                if not st.session_state.results:
+                    recovered = load_existing_labels(st.session_state.save_file)
+                    urls_all = st.session_state.get('urls')
+                    if urls_all is None:
+                        urls_all = st.session_state.urls = tuple(
+                            st.session_state.galaxy_data['image_url'].astype(str).tolist()
+                        )
+                    valid = {
+                        i: r for i, r in recovered.items()
+                        if 0 <= i < len(urls_all) and r.get('url') == urls_all[i]
+                    }
+                    if valid:
+                        st.session_state.results.update(valid)
+                        st.sidebar.info(f"💡 已从磁盘恢复 {len(valid)} 条标注")
+                    if len(valid) != len(recovered):
+                        st.sidebar.warning(
+                            f"⚠️ 磁盘文件中有 {len(recovered) - len(valid)} 条标注与当前数据集不匹配, 已忽略"
+                        )
     
     # 显示完整保存路径
     if st.session_state.save_file:
@@ -290,6 +751,11 @@ if st.session_state.data_loaded:
     progress = stats['classified'] / stats['total'] if stats['total'] > 0 else 0
     st.sidebar.progress(progress, text=f"进度: {progress*100:.1f}%")
 
+    # 随时可手动导出合并后的 JSON 快照 (增量保存走 JSONL)
+    if st.sidebar.button("💾 保存为 JSON", use_container_width=True):
+        if save_results(st.session_state.save_file, st.session_state.results):
+            st.sidebar.success(f"✅ 已保存到: {st.session_state.save_file}")
+
 
 # ============================================================================
 # 主界面 - 标注界面
@@ -364,9 +830,15 @@ else:
                 st.success(f"✅ 已保存到: {st.session_state.save_file}")
         
         if st.button("导出为 CSV"):
-            results_df = pd.DataFrame(list(st.session_state.results.values()))
             csv_file = st.session_state.save_file.with_suffix('.csv')
-            results_df.to_csv(csv_file, index=False)
+            # 直接流式写出, 不经过中间 DataFrame 和 dtype 推断
+            with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=['url', 'classification', 'index', 'timestamp'])
+                writer.writeheader()
+                writer.writerows(
+                    {k: r.get(k) for k in ('url', 'classification', 'index', 'timestamp')}
+                    for r in st.session_state.results.values()
+                )
             st.success(f"✅ 已导出到: {csv_file}")
         
         if st.button("🔄 重新开始"):
@@ -374,277 +846,7 @@ else:
             st.rerun()
         
     else:
-        # 获取当前星系数据
-        current_row = df.iloc[idx]
-        url = current_row['image_url']
-        
-        # 检查是否已标注
-        is_labeled = idx in st.session_state.results
-        
-        # 标题和进度
-        st.title(f"🌌 Galaxy {idx + 1} of {len(df)}")
-        
-        # 进度条
-        progress = idx / len(df)
-        st.progress(progress, text=f"进度: {idx + 1}/{len(df)}")
-        
-        # 显示元数据
-        with st.expander("📋 星系元数据"):
-            metadata_cols = [col for col in df.columns if col != 'image_url']
-            if metadata_cols:
-                for col in metadata_cols:
-                    st.text(f"{col}: {current_row[col]}")
-            else:
-                st.info("无额外元数据")
-        
-        st.markdown("---")
-        
-        # 图像显示区域
-        col_img, col_controls = st.columns([2, 1])
-        
-        with col_img:
-            # 加载图像
-            with st.spinner("加载图像中..."):
-                img = load_image_from_url(url)
-            
-            if img is not None:
-                # 图像反转
-                if st.session_state.is_inverted:
-                    if img.mode == 'RGBA':
-                        r, g, b, a = img.split()
-                        rgb = Image.merge('RGB', (r, g, b))
-                        inverted_rgb = ImageOps.invert(rgb)
-                        r2, g2, b2 = inverted_rgb.split()
-                        img = Image.merge('RGBA', (r2, g2, b2, a))
-                    else:
-                        if img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        img = ImageOps.invert(img)
-                
-                st.image(img, use_container_width=True, caption=f"Galaxy {idx + 1}")
-        
-        with col_controls:
-            st.header("🎮 控制面板")
-            
-            # 编辑模式开关
-            st.subheader("🔓 编辑模式")
-            edit_mode = st.toggle(
-                "启用编辑模式",
-                value=st.session_state.edit_mode,
-                key="edit_mode_toggle",
-                help="开启后可以修改已标注的结果"
-            )
-            st.session_state.edit_mode = edit_mode
-            
-            if edit_mode:
-                st.warning("⚠️ 编辑模式已启用 - 可修改已标注结果")
-            else:
-                st.info("🔒 编辑模式已关闭 - 已标注结果被锁定")
-            
-            st.markdown("---")
-            
-            # 图像控制
-            st.subheader("🖼️ 图像控制")
-            if st.button("🔄 反转图像", use_container_width=True, key="invert_btn"):
-                st.session_state.is_inverted = not st.session_state.is_inverted
-                st.rerun()
-            
-            if st.session_state.is_inverted:
-                st.info("📍 当前: 反转模式")
-            else:
-                st.info("📍 当前: 正常模式")
-            
-            st.markdown("---")
-            
-            # 分类按钮
-            st.subheader("🏷️ 分类")
-            
-            # 检查是否已标注和编辑模式状态
-            if is_labeled and not st.session_state.edit_mode:
-                # 显示已有标注（锁定状态）
-                result = st.session_state.results[idx]
-                classification = result['classification']
-                timestamp = result.get('timestamp', 'Unknown')
-                
-                if classification == 'has_stream':
-                    st.success("✅ Has Stream")
-                elif classification == 'no_stream':
-                    st.error("❌ No Stream")
-                else:
-                    st.warning("⏭️ Skipped")
-                
-                st.caption(f"标注时间: {timestamp}")
-                st.info("🔒 已标注,不可修改 (开启编辑模式以更改)")
-                
-            else:
-                # 显示分类按钮（未标注 或 编辑模式已启用）
-                if is_labeled and st.session_state.edit_mode:
-                    st.warning("⚠️ 编辑模式已启用 - 可以修改此标注")
-                    # 显示当前标注
-                    result = st.session_state.results[idx]
-                    classification = result['classification']
-                    if classification == 'has_stream':
-                        st.info("当前: ✅ Has Stream")
-                    elif classification == 'no_stream':
-                        st.info("当前: ❌ No Stream")
-                    else:
-                        st.info("当前: ⏭️ Skipped")
-                
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    if st.button("✅ Has\nStream", use_container_width=True, type="primary", key="has_stream_btn"):
-                        result = {
-                            'url': url,
-                            'classification': 'has_stream',
-                            'index': idx,
-                            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            'metadata': current_row.to_dict()
-                        }
-                        if is_labeled:
-                            result['edited'] = True
-                        
-                        st.session_state.results[idx] = result
-                        
-                        # 如果是编辑，立即保存；否则使用自动保存
-                        if is_labeled and st.session_state.edit_mode:
-                            if save_results(st.session_state.save_file, st.session_state.results):
-                                st.success("✅ 已修改为 Has Stream 并立即保存")
-                        else:
-                            # 新标注更新计数器
-                            st.session_state.labels_since_save += 1
-                            
-                            # 自动保存逻辑
-                            if st.session_state.labels_since_save >= st.session_state.auto_save_interval:
-                                save_results(st.session_state.save_file, st.session_state.results)
-                                st.session_state.labels_since_save = 0
-                                st.success("✅ 已标注: Has Stream (已自动保存)")
-                            else:
-                                st.success(f"✅ 已标注: Has Stream ({st.session_state.labels_since_save}/{st.session_state.auto_save_interval})")
-                        st.rerun()
-                
-                with col2:
-                    if st.button("❌ No\nStream", use_container_width=True, key="no_stream_btn"):
-                        result = {
-                            'url': url,
-                            'classification': 'no_stream',
-                            'index': idx,
-                            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            'metadata': current_row.to_dict()
-                        }
-                        if is_labeled:
-                            result['edited'] = True
-                        
-                        st.session_state.results[idx] = result
-                        
-                        # 如果是编辑，立即保存；否则使用自动保存
-                        if is_labeled and st.session_state.edit_mode:
-                            if save_results(st.session_state.save_file, st.session_state.results):
-                                st.success("✅ 已修改为 No Stream 并立即保存")
-                        else:
-                            # 新标注更新计数器
-                            st.session_state.labels_since_save += 1
-                            
-                            # 自动保存逻辑
-                            if st.session_state.labels_since_save >= st.session_state.auto_save_interval:
-                                save_results(st.session_state.save_file, st.session_state.results)
-                                st.session_state.labels_since_save = 0
-                                st.success("✅ 已标注: No Stream (已自动保存)")
-                            else:
-                                st.success(f"✅ 已标注: No Stream ({st.session_state.labels_since_save}/{st.session_state.auto_save_interval})")
-                        st.rerun()
-                
-                with col3:
-                    if st.button("⏭️ Skip", use_container_width=True, key="skip_btn"):
-                        result = {
-                            'url': url,
-                            'classification': 'skipped',
-                            'index': idx,
-                            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            'metadata': current_row.to_dict()
-                        }
-                        if is_labeled:
-                            result['edited'] = True
-                        
-                        st.session_state.results[idx] = result
-                        
-                        # 如果是编辑，立即保存；否则使用自动保存
-                        if is_labeled and st.session_state.edit_mode:
-                            if save_results(st.session_state.save_file, st.session_state.results):
-                                st.warning("⏭️ 已修改为 Skipped 并立即保存")
-                        else:
-                            # 新标注更新计数器
-                            st.session_state.labels_since_save += 1
-                            
-                            # 自动保存逻辑
-                            if st.session_state.labels_since_save >= st.session_state.auto_save_interval:
-                                save_results(st.session_state.save_file, st.session_state.results)
-                                st.session_state.labels_since_save = 0
-                                st.warning("⏭️ 已跳过 (已自动保存)")
-                            else:
-                                st.warning(f"⏭️ 已跳过 ({st.session_state.labels_since_save}/{st.session_state.auto_save_interval})")
-                        st.rerun()
-                
-                if is_labeled and st.session_state.edit_mode:
-                    st.caption("修改将立即保存")
-                else:
-                    st.caption("请选择分类")
-        
-        st.markdown("---")
-        
-        # 导航按钮
-        col_prev, col_next = st.columns(2)
-        
-        with col_prev:
-            if st.button("⬅️ 上一个", use_container_width=True, disabled=(idx == 0), key="prev_btn"):
-                st.session_state.current_index = max(0, idx - 1)
-                st.session_state.is_inverted = False
-                st.rerun()
-        
-        with col_next:
-            # 修改禁用条件：到达最后一个 或者 当前未标注
-            next_disabled = (idx >= len(df) - 1) or not is_labeled
-            next_btn_text = "下一个 ➡️" if is_labeled else "下一个 ➡️ (需先标注)"
-            if st.button(next_btn_text, use_container_width=True, disabled=next_disabled, type="primary", key="next_btn"):
-                st.session_state.current_index = min(len(df) - 1, idx + 1)
-                st.session_state.is_inverted = False
-                st.rerun()
-        
-        # 状态提示
-        if not is_labeled:
-            st.warning("⚠️ 警告: 请先分类当前星系才能继续到下一个")
-        
-        # 快捷键提示
-        with st.expander("⌨️ 快捷键说明"):
-            st.markdown("""
-            - **E**: 切换编辑模式
-            - **I**: 反转图像
-            - **Y**: 标注为 Has Stream
-            - **N**: 标注为 No Stream
-            - **S**: 跳过当前图像
-            - **←**: 上一个星系
-            - **→**: 下一个星系
-            """)
-        
-        # 添加快捷键支持 - 移到这里以确保所有按钮都已渲染
-        # 根据当前状态动态调整快捷键
-        shortcut_config = {
-            "edit_mode_toggle": "e",      # E键切换编辑模式
-            "invert_btn": "i",            # I键反转图像
-            "prev_btn": "arrowleft",      # 左箭头上一个
-        }
-        
-        # 只有在未标注或编辑模式开启时才启用分类快捷键
-        if not is_labeled or st.session_state.edit_mode:
-            shortcut_config["has_stream_btn"] = "y"   # Y键标注为Has Stream
-            shortcut_config["no_stream_btn"] = "n"    # N键标注为No Stream
-            shortcut_config["skip_btn"] = "s"         # S键跳过
-        
-        # 只有在已标注时才启用下一个快捷键（已移除，现在自动前进）
-        # if is_labeled and idx < len(df) - 1:
-        #     shortcut_config["next_btn"] = "arrowright"  # 右箭头下一个
-        
-        add_shortcuts(**shortcut_config)
+        annotation_panel(df)
 
 
 # ============================================================================